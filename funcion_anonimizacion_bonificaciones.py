@@ -1,116 +1,393 @@
 import pandas as pd
+import numpy as np
 import hashlib
 import os
+import re
+from datetime import date, datetime, time, timedelta, timezone
 from io import BytesIO
+from xml.sax.saxutils import escape, quoteattr
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import openpyxl
+import openpyxl.writer.excel
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Motor de lectura de Excel: calamine (Rust) si está instalado, si no el de pandas por defecto
+try:
+    import python_calamine  # noqa: F401
+    MOTOR_EXCEL = "calamine"
+except ImportError:
+    MOTOR_EXCEL = None
+
+# Grupos de columnas para anonimizar y grupo al que pertenece cada columna
+grupos_columnas = {
+    "Rut 1": ["Rut 1", "Rut beneficiario"],
+    "Rut 2": ["Rut 2", "RUT Trabajador"],
+    "ID SAP": ["ID SAP", "No.Personal"]
+}
+grupo_por_columna = {col: grupo for grupo, cols in grupos_columnas.items() for col in cols}
+
+# Reconoce el grupo de una hoja de mapeo por los nombres de columna que contiene, en el orden de grupos_columnas;
+# un nombre seguido de un dígito no calza ("Rut 1" no calza con "Rut 10")
+patrones_grupo_hoja = [
+    (grupo, re.compile("|".join(re.escape(col) + r"(?!\d)" for col in cols)))
+    for grupo, cols in grupos_columnas.items()
+]
 
 # ---------------- FUNCIÓN PRINCIPAL -----------------
 
-def procesar_bonificaciones(archivo_existente, archivo_nuevo, archivo_mapeo):
+def anonimizar_ids(valores):
+    """Anonimiza determinísticamente un conjunto de valores (SHA-256 truncado a 10 caracteres)."""
+    sha256 = hashlib.sha256
+    return [sha256(v.encode()).hexdigest()[:10] for v in np.asarray(valores, dtype=str).tolist()]
+
+def claves_mapeo(valores):
+    """Texto con el que se indexan los mapeos; los float enteros (12345.0, columnas con vacíos) quedan como 12345."""
+    return np.array([str(int(v)) if isinstance(v, float) and v.is_integer() else str(v) for v in valores], dtype=str)
+
+def ruta_mapeo_parquet(archivo_mapeo):
+    """Ruta del diccionario global en Parquet, junto al Excel indicado."""
+    return os.path.splitext(archivo_mapeo)[0] + ".parquet"
+
+def usar_mapeo_parquet(archivo_mapeo):
+    """Indica si el diccionario debe leerse de su Parquet: solo si existe y es más reciente que el Excel indicado."""
+    if not isinstance(archivo_mapeo, (str, os.PathLike)):
+        return False
+    archivo_parquet = ruta_mapeo_parquet(archivo_mapeo)
+    if not os.path.exists(archivo_parquet):
+        return False
+    return not os.path.exists(archivo_mapeo) or os.path.getmtime(archivo_parquet) > os.path.getmtime(archivo_mapeo)
+
+def cargar_mapeos_parquet(archivo_parquet):
+    """Lee el diccionario global guardado en Parquet (formato largo: grupo, real, real_numerico, anon)."""
+    df_mapeo = pd.read_parquet(archivo_parquet)
+    mapeos_globales = {}
+    for grupo, df_grupo in df_mapeo.groupby("grupo", sort=False):
+        claves = df_grupo["real"].to_numpy(dtype=str)
+        # Los valores reales numéricos vuelven a ser números, como en el Excel de origen
+        reales = claves.astype(object)
+        numericos = df_grupo["real_numerico"].to_numpy(dtype=bool)
+        reales[numericos] = pd.to_numeric(df_grupo["real"][numericos]).to_numpy(dtype=object)
+        mapeos_globales[grupo] = (claves, reales, df_grupo["anon"].to_numpy(dtype=str))
+    return mapeos_globales
+
+def cargar_mapeos(archivo_mapeo):
     """
-    Procesa y anonimiza nuevas bonificaciones, actualizando el consolidado existente y el diccionario global.
-    Parámetros:
-        archivo_existente: ruta al Excel consolidado existente
-        archivo_nuevo: ruta al nuevo archivo de bonificaciones
-        archivo_mapeo: ruta al diccionario global de IDs anonimizados
-    Retorna:
-        df_final (DataFrame): consolidado actualizado
-        mapeos_globales (dict): diccionario con todos los mapeos actualizados
+    Lee el diccionario global de IDs anonimizados (una hoja por grupo).
+    Si es una ruta y su versión Parquet (ver ruta_mapeo_parquet) es más reciente, se usa esa.
+    Cada grupo queda como tres arrays paralelos: (claves de búsqueda en texto, ver claves_mapeo;
+    valores reales originales; valores anonimizados).
     """
+    if usar_mapeo_parquet(archivo_mapeo):
+        return cargar_mapeos_parquet(ruta_mapeo_parquet(archivo_mapeo))
 
-    def anonimizar_id(valor):
-        """Anonimiza determinísticamente un valor (hash truncado a 10 caracteres)."""
-        return hashlib.sha256(str(valor).encode()).hexdigest()[:10]
-
-    # Cargar mapeos globales
     mapeos_globales = {}
-    if os.path.exists(archivo_mapeo):
-        xls = pd.ExcelFile(archivo_mapeo)
-        for hoja in xls.sheet_names:
+    if not isinstance(archivo_mapeo, (str, os.PathLike)) or os.path.exists(archivo_mapeo):
+        hojas = pd.read_excel(archivo_mapeo, sheet_name=None, engine=MOTOR_EXCEL)
+        for hoja, df_mapeo in hojas.items():
             nombre_hoja = hoja.replace("Grupo_", "")
-            df_mapeo = pd.read_excel(archivo_mapeo, sheet_name=hoja)
             if len(df_mapeo.columns) >= 2:
                 col_real, col_anon = df_mapeo.columns[:2]
-                if "Rut 1" in nombre_hoja or "Rut beneficiario" in nombre_hoja:
-                    clave = "Rut 1"
-                elif "Rut 2" in nombre_hoja or "RUT Trabajador" in nombre_hoja:
-                    clave = "Rut 2"
-                elif "ID SAP" in nombre_hoja or "No.Personal" in nombre_hoja:
-                    clave = "ID SAP"
-                else:
-                    clave = nombre_hoja
-                mapeos_globales[clave] = dict(zip(df_mapeo[col_real], df_mapeo[col_anon]))
-
-    # Cargar consolidado y nuevo archivo
-    df_existente = pd.read_excel(archivo_existente)
-    df_nuevo = pd.read_excel(archivo_nuevo)
+                clave = next((grupo for grupo, patron in patrones_grupo_hoja if patron.search(nombre_hoja)), nombre_hoja)
+                df_mapeo = df_mapeo.dropna(subset=[col_real])
+                reales = df_mapeo[col_real].to_numpy(dtype=object)
+                claves = claves_mapeo(reales)
+                unicos = ~pd.Series(claves).duplicated(keep="last").to_numpy()
+                mapeos_globales[clave] = (
+                    claves[unicos], reales[unicos], df_mapeo[col_anon].to_numpy(dtype=str)[unicos]
+                )
+    return mapeos_globales
+
+def cargar_archivos(archivo_existente, archivo_nuevo, archivo_mapeo, cargar_mapeo=cargar_mapeos,
+                    initializer=None, initargs=()):
+    """
+    Lee en paralelo el consolidado, el nuevo archivo y el diccionario global de IDs anonimizados.
+    cargar_mapeo es la función que lee archivo_mapeo (por defecto cargar_mapeos);
+    initializer e initargs se pasan al ThreadPoolExecutor de las lecturas.
+    """
+    with ThreadPoolExecutor(max_workers=3, initializer=initializer, initargs=initargs) as ex:
+        futuro_existente = ex.submit(pd.read_excel, archivo_existente, engine=MOTOR_EXCEL)
+        futuro_nuevo = ex.submit(pd.read_excel, archivo_nuevo, engine=MOTOR_EXCEL)
+        futuro_mapeo = ex.submit(cargar_mapeo, archivo_mapeo)
+    return futuro_existente.result(), futuro_nuevo.result(), futuro_mapeo.result()
+
+def anonimizar_bonificaciones(df_existente, df_nuevo, mapeos_globales):
+    """
+    Anonimiza el nuevo archivo de bonificaciones y lo alinea con las columnas del consolidado.
+    Los valores nuevos se agregan a mapeos_globales, que se modifica en el lugar.
+    Retorna:
+        df_nuevo (DataFrame): filas nuevas anonimizadas, listas para agregar bajo el consolidado
+    """
 
     # Eliminar columnas sensibles
     cols_eliminar = [
         "BE_AP_PAT_ASEG", "BE_AP_MAT_ASEG", "BE_NOMB_ASEG",
         "BE_AP_PAT_PACI", "BE_AP_MAT_PACI", "BE_NOMB_PACI"
     ]
-    df_nuevo = df_nuevo.drop(columns=[c for c in cols_eliminar if c in df_nuevo.columns])
-
-    # Grupos de columnas para anonimizar
-    grupos_columnas = {
-        "Rut 1": ["Rut 1", "Rut beneficiario"],
-        "Rut 2": ["Rut 2", "RUT Trabajador"],
-        "ID SAP": ["ID SAP", "No.Personal"]
-    }
+    df_nuevo = df_nuevo.drop(columns=cols_eliminar, errors="ignore")
 
     # Aplicar anonimización consistente
-    for col in df_nuevo.columns:
-        for grupo_base, columnas_grupo in grupos_columnas.items():
-            if col in columnas_grupo:
-                mapeo = mapeos_globales.get(grupo_base, {})
-                for valor in df_nuevo[col].dropna().unique():
-                    if valor not in mapeo:
-                        mapeo[valor] = anonimizar_id(valor)
-                df_nuevo[col] = df_nuevo[col].map(mapeo)
-                mapeos_globales[grupo_base] = mapeo
-                break
+    for col in df_nuevo.columns.intersection(grupo_por_columna):
+        grupo_base = grupo_por_columna[col]
+        claves, reales, anonimos = mapeos_globales.get(
+            grupo_base, (np.array([], dtype=str), np.array([], dtype=object), np.array([], dtype=str))
+        )
+        # Trabajar sobre los valores únicos y reconstruir la columna con sus códigos
+        codigos, unicos = pd.factorize(df_nuevo[col])
+        claves_unicos = claves_mapeo(unicos)
+        posiciones = pd.Index(claves).get_indexer(claves_unicos)
+        nuevos = posiciones == -1
+        # Solo los valores sin mapeo previo se hashean y se agregan; si no hay, el mapeo no se copia
+        if nuevos.any():
+            # Una sola pasada sobre los faltantes: sus posiciones al final del mapeo y las claves a agregar,
+            # cada una con su primer valor original, que es el que se hashea y se guarda en el diccionario
+            codigos_nuevos, claves_nuevas = pd.factorize(claves_unicos[nuevos])
+            primeros = np.unique(codigos_nuevos, return_index=True)[1]
+            reales_nuevos = np.asarray(unicos, dtype=object)[nuevos][primeros]
+            posiciones[nuevos] = len(claves) + codigos_nuevos
+            claves = np.concatenate([claves, claves_nuevas.astype(str)])
+            reales = np.concatenate([reales, reales_nuevos])
+            anonimos = np.concatenate([anonimos, np.array(anonimizar_ids(reales_nuevos), dtype=str)])
+        valores = np.append(anonimos[posiciones].astype(object), np.nan)
+        df_nuevo[col] = valores[codigos]  # el código -1 (nulo) apunta al NaN final
+        mapeos_globales[grupo_base] = (claves, reales, anonimos)
 
     # Alinear columnas con el consolidado
-    df_nuevo = df_nuevo[df_existente.columns]
+    return df_nuevo[df_existente.columns]
+
+def procesar_bonificaciones(archivo_existente, archivo_nuevo, archivo_mapeo):
+    """
+    Procesa y anonimiza nuevas bonificaciones, devolviendo el consolidado actualizado y actualizando el diccionario global.
+    Parámetros:
+        archivo_existente: ruta o archivo en memoria (BytesIO) del Excel consolidado existente
+        archivo_nuevo: ruta o archivo en memoria del nuevo archivo de bonificaciones
+        archivo_mapeo: ruta o archivo en memoria del diccionario global de IDs anonimizados;
+            si es una ruta, el diccionario actualizado se guarda en Parquet junto a ella
+    Retorna:
+        df_final (DataFrame): consolidado actualizado
+        mapeos_globales (dict): mapeos actualizados por grupo, como tríos (claves de búsqueda, valores reales, valores anonimizados)
+    """
+
+    df_existente, df_nuevo, mapeos_globales = cargar_archivos(archivo_existente, archivo_nuevo, archivo_mapeo)
+    df_nuevo = anonimizar_bonificaciones(df_existente, df_nuevo, mapeos_globales)
 
     # Concatenar
     df_final = pd.concat([df_existente, df_nuevo], ignore_index=True)
 
-    # Guardar resultados actualizados
-    df_final.to_excel(archivo_existente, index=False)
-
-    # Guardar mapeos actualizados
-    with pd.ExcelWriter(archivo_mapeo, mode="w") as writer:
-        for grupo, mapeo in mapeos_globales.items():
-            df_mapeo = pd.DataFrame(list(mapeo.items()), columns=[f"{grupo}_real", f"{grupo}_anon"])
-            df_mapeo.to_excel(writer, sheet_name=f"Grupo_{grupo}"[:31], index=False)
+    # Guardar mapeos actualizados en Parquet (solo si el diccionario viene de una ruta en disco)
+    if isinstance(archivo_mapeo, (str, os.PathLike)):
+        guardar_mapeos_en_parquet(mapeos_globales, ruta_mapeo_parquet(archivo_mapeo))
 
     return df_final, mapeos_globales
 
 
 # ---------------- FUNCIÓN AUXILIAR -----------------
 
+# Nivel DEFLATE de los .xlsx generados: 1 es mucho más rápido que el 6 por defecto y comprime casi lo mismo
+NIVEL_COMPRESION_XLSX = 1
+
 nombre_columnas = {
     "Rut 1": ["Rut 1_real","Rut 1_anon"],
     "Rut 2":["Rut 2_real","Rut 2_anon"],
     "ID SAP": ["ID SAP_real","ID SAP_anon"]
 }
 
+# Tamaño máximo de una hoja de Excel
+FILAS_MAX_EXCEL = 1_048_576
+COLUMNAS_MAX_EXCEL = 16_384
+
+def validar_tamano_hoja(filas, columnas):
+    """Levanta ValueError si la hoja no cabe en Excel, con el mismo mensaje que DataFrame.to_excel."""
+    if filas > FILAS_MAX_EXCEL or columnas > COLUMNAS_MAX_EXCEL:
+        raise ValueError(
+            f"This sheet is too large! Your sheet size is: {filas}, {columnas} "
+            f"Max sheet size is: {FILAS_MAX_EXCEL}, {COLUMNAS_MAX_EXCEL}"
+        )
+
 def guardar_diccionario_en_excel(diccionario, nombre_archivo, nombre_columnas):
     """Genera un Excel con los mapeos, con nombres de columnas personalizados."""
-    with pd.ExcelWriter(nombre_archivo, engine='openpyxl') as writer:
-        for hoja, subdic in diccionario.items():
-            cols = nombre_columnas.get(hoja, ['Llave', 'Valor'])
-            df = pd.DataFrame(list(subdic.items()), columns=cols)
-            df.to_excel(writer, sheet_name=hoja, index=False)
+    libro = openpyxl.Workbook(write_only=True)
+    for hoja, (_, reales, anonimos) in diccionario.items():
+        validar_tamano_hoja(len(reales) + 1, 2)
+        ws = libro.create_sheet(hoja)
+        ws.append(nombre_columnas.get(hoja, ['Llave', 'Valor']))
+        for fila in zip(reales.tolist(), anonimos.tolist()):
+            ws.append(fila)
+    # Lo mismo que hace Workbook.save, que no permite elegir el nivel de compresión
+    if not libro.worksheets:
+        libro.create_sheet()
+    libro.properties.modified = datetime.now(timezone.utc).replace(tzinfo=None)
+    with zipfile.ZipFile(nombre_archivo, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                         compresslevel=NIVEL_COMPRESION_XLSX) as archivo:
+        openpyxl.writer.excel.ExcelWriter(libro, archivo).save()
+    return nombre_archivo
+
+def guardar_mapeos_en_parquet(diccionario, nombre_archivo):
+    """
+    Guarda los mapeos en un solo Parquet en formato largo, comprimido con zstd.
+    El valor real se guarda como su clave de texto (real) y real_numerico indica si era un número.
+    """
+    partes = [
+        pd.DataFrame({
+            "grupo": grupo,
+            "real": claves,
+            "real_numerico": [isinstance(v, (int, float, np.number)) and not isinstance(v, (bool, np.bool_))
+                              for v in reales],
+            "anon": anonimos
+        })
+        for grupo, (claves, reales, anonimos) in diccionario.items()
+    ]
+    df_mapeo = (pd.concat(partes, ignore_index=True) if partes
+                else pd.DataFrame(columns=["grupo", "real", "real_numerico", "anon"]))
+    df_mapeo.to_parquet(nombre_archivo, compression="zstd", index=False)
+    return nombre_archivo
+
+# Plantilla mínima de un .xlsx de una hoja, sin estilos salvo los formatos de fecha (s="1"), hora (s="2") y duración (s="3")
+_XLSX_PLANTILLA = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name={hoja} sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy\\-mm\\-dd\\ hh:mm:ss"/></numFmts>'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="4"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="21" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="46" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+_XLSX_HOJA_INICIO = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_XLSX_HOJA_FIN = '</sheetData></worksheet>'
+_XML_ILEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_EPOCA_EXCEL = pd.Timestamp("1899-12-30")
+_FILAS_POR_BLOQUE = 50_000
+
+def _letra_columna(indice):
+    """Convierte un índice de columna (base 0) en su letra de Excel: A, B, ..., Z, AA, ..."""
+    letra = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letra = chr(65 + resto) + letra
+    return letra
+
+def _cola_celda(valor):
+    """Resto del XML de una celda a partir de su valor ('' si la celda queda vacía)."""
+    if valor is None or valor is pd.NA or valor is pd.NaT:
+        return ""
+    if isinstance(valor, (bool, np.bool_)):
+        return f'" t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (timedelta, np.timedelta64)):
+        return f'" s="3"><v>{pd.Timedelta(valor) / pd.Timedelta(days=1)}</v></c>'
+    if isinstance(valor, (int, float, np.number)):
+        return f'"><v>{valor}</v></c>' if np.isfinite(valor) else ""
+    if isinstance(valor, (datetime, date)):
+        return f'" s="1"><v>{(pd.Timestamp(valor) - _EPOCA_EXCEL) / pd.Timedelta(days=1)}</v></c>'
+    if isinstance(valor, time):
+        segundos = valor.hour * 3600 + valor.minute * 60 + valor.second + valor.microsecond / 1e6
+        return f'" s="2"><v>{segundos / 86400}</v></c>'
+    texto = escape(_XML_ILEGAL.sub("", str(valor)))
+    return f'" t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+def _colas_columna(columna):
+    """Versión vectorizada de _cola_celda para una columna completa."""
+    if pd.api.types.is_bool_dtype(columna):
+        return '" t="b"><v>' + columna.astype(int).astype(str) + '</v></c>'
+    if pd.api.types.is_timedelta64_dtype(columna):
+        serial = columna / pd.Timedelta(days=1)
+        return ('" s="3"><v>' + serial.astype(str) + '</v></c>').where(columna.notna(), "")
+    if pd.api.types.is_numeric_dtype(columna):
+        validos = columna.notna() & ~columna.isin([np.inf, -np.inf])
+        return ('"><v>' + columna.astype(str) + '</v></c>').where(validos, "")
+    if pd.api.types.is_datetime64_any_dtype(columna):
+        if columna.dt.tz is not None:
+            columna = columna.dt.tz_localize(None)
+        serial = (columna - _EPOCA_EXCEL) / pd.Timedelta(days=1)
+        return ('" s="1"><v>' + serial.astype(str) + '</v></c>').where(columna.notna(), "")
+    return columna.astype(object).map(_cola_celda)
+
+def _filas_xml(df, fila_inicial):
+    """Genera el XML de las filas de un DataFrame, comenzando en la fila de Excel indicada."""
+    df = df.reset_index(drop=True)
+    filas = pd.Series(np.arange(fila_inicial, fila_inicial + len(df)).astype(str))
+    celdas = pd.Series("", index=df.index, dtype=object)
+    for j in range(df.shape[1]):
+        cola = _colas_columna(df.iloc[:, j])
+        celdas += ('<c r="' + _letra_columna(j) + filas + cola).where(cola != "", "")
+    return "".join('<row r="' + filas + '">' + celdas + '</row>')
+
+def guardar_consolidado_en_excel(partes, nombre_archivo, hoja='Procesado'):
+    """
+    Escribe uno o varios DataFrames (con las mismas columnas) como una sola hoja .xlsx,
+    uno a continuación del otro, generando directamente el XML de la hoja.
+    """
+    if isinstance(partes, pd.DataFrame):
+        partes = [partes]
+    validar_tamano_hoja(1 + sum(len(df) for df in partes), partes[0].shape[1])
+    with zipfile.ZipFile(nombre_archivo, "w", zipfile.ZIP_DEFLATED, compresslevel=NIVEL_COMPRESION_XLSX) as xlsx:
+        for nombre, contenido in _XLSX_PLANTILLA.items():
+            xlsx.writestr(nombre, contenido.replace("{hoja}", quoteattr(hoja)))
+        with xlsx.open("xl/worksheets/sheet1.xml", "w") as hoja_xml:
+            hoja_xml.write(_XLSX_HOJA_INICIO.encode())
+            hoja_xml.write(_filas_xml(pd.DataFrame([partes[0].columns.astype(str)]), 1).encode())
+            fila_excel = 2
+            for df in partes:
+                for inicio in range(0, len(df), _FILAS_POR_BLOQUE):
+                    bloque = df.iloc[inicio:inicio + _FILAS_POR_BLOQUE]
+                    hoja_xml.write(_filas_xml(bloque, fila_excel).encode())
+                    fila_excel += len(bloque)
+            hoja_xml.write(_XLSX_HOJA_FIN.encode())
     return nombre_archivo
 
 
 
 # ---------------- APP STREAMLIT -----------------
 
+# Diccionario cacheado por contenido. Dentro de una sesión no se reutiliza (el procesamiento corre una sola vez);
+# sirve cuando otra sesión, p. ej. tras Ctrl + R, sube el mismo diccionario. A cambio, el caché es compartido
+# entre sesiones y guarda los IDs reales sin anonimizar (RUT, ID SAP) en memoria del servidor hasta por ttl segundos
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def cargar_mapeos_cacheado(contenido):
+    """Carga el diccionario global de IDs anonimizados a partir de sus bytes."""
+    return cargar_mapeos(BytesIO(contenido))
+
 st.title("Anonimización de Bonificaciones")
 
 archivo_nuevo = st.file_uploader("📄 Suba el archivo del mes a agregar", type=["xls", "xlsx"])
@@ -120,37 +397,39 @@ archivo_mapeo = st.file_uploader("📄 Suba el archivo de diccionario ID anonimi
 if archivo_nuevo and archivo_existente and archivo_mapeo and "df_procesado" not in st.session_state:
     try:
         with st.spinner("⏳ Procesando los archivos, por favor espere..."):
-            # Guardar archivos temporales
-            with open("tmp_existente.xlsx", "wb") as f:
-                f.write(archivo_existente.getbuffer())
-            with open("tmp_nuevo.xlsx", "wb") as f:
-                f.write(archivo_nuevo.getbuffer())
-            with open("tmp_mapeo.xlsx", "wb") as f:
-                f.write(archivo_mapeo.getbuffer())
-
-            # Ejecutar función principal
-            df_procesado, mapeos_globales = procesar_bonificaciones(
-                "tmp_existente.xlsx", "tmp_nuevo.xlsx", "tmp_mapeo.xlsx"
+            # Leer en paralelo los archivos subidos, en memoria; los hilos comparten el contexto de Streamlit,
+            # que necesita el diccionario cacheado
+            df_existente, df_nuevo, mapeos_globales = cargar_archivos(
+                BytesIO(archivo_existente.getvalue()),
+                BytesIO(archivo_nuevo.getvalue()),
+                archivo_mapeo.getvalue(),
+                cargar_mapeo=cargar_mapeos_cacheado,
+                initializer=add_script_run_ctx,
+                initargs=(None, get_script_run_ctx())
             )
 
-            # Crear archivos Excel en memoria
-            procesado_buffer = BytesIO()
-            with pd.ExcelWriter(procesado_buffer, engine='openpyxl') as writer:
-                df_procesado.to_excel(writer, index=False, sheet_name='Procesado')
-            procesado_buffer.seek(0)
+            # Anonimizar
+            df_nuevo = anonimizar_bonificaciones(df_existente, df_nuevo, mapeos_globales)
+
+            # El consolidado se escribe por partes (existente + nuevo) sin concatenarlo en memoria
+            df_procesado = [df_existente, df_nuevo]
 
-            # Crear Excel de mapeos usando la función auxiliar
+            # Crear en paralelo el Excel procesado y el de mapeos (función auxiliar) en memoria
+            procesado_buffer = BytesIO()
             mapeo_buffer = BytesIO()
-            with pd.ExcelWriter(mapeo_buffer, engine='openpyxl') as writer:
-                for hoja, subdic in mapeos_globales.items():
-                    cols = nombre_columnas.get(hoja, ['Llave', 'Valor'])
-                    df_m = pd.DataFrame(list(subdic.items()), columns=cols)
-                    df_m.to_excel(writer, sheet_name=hoja, index=False)
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                futuros = [
+                    ex.submit(guardar_consolidado_en_excel, df_procesado, procesado_buffer),
+                    ex.submit(guardar_diccionario_en_excel, mapeos_globales, mapeo_buffer, nombre_columnas)
+                ]
+            for futuro in futuros:
+                futuro.result()
+            procesado_buffer.seek(0)
             mapeo_buffer.seek(0)
 
-            # Empaquetar ambos en un ZIP
+            # Empaquetar ambos en un ZIP (sin recomprimir: los .xlsx ya vienen comprimidos)
             zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_file:
                 zip_file.writestr("Bonificaciones_Procesadas.xlsx", procesado_buffer.getvalue())
                 zip_file.writestr("Diccionario_Anonimizacion.xlsx", mapeo_buffer.getvalue())
             zip_buffer.seek(0)
@@ -160,11 +439,6 @@ if archivo_nuevo and archivo_existente and archivo_mapeo and "df_procesado" not
 
         st.success("✅ Archivos procesados con éxito")
 
-        # Limpiar archivos temporales
-        for f in ["tmp_existente.xlsx", "tmp_nuevo.xlsx", "tmp_mapeo.xlsx"]:
-            if os.path.exists(f):
-                os.remove(f)
-
     except Exception as e:
         st.error(f"❌ Ocurrió un error: {e}")
 